@@ -3,17 +3,33 @@
 Using psycopg3, Supabase Storage, Flask
 """
 
+from gevent import get_hub, monkey
+monkey.patch_all()
+
 import os
+import atexit
+import threading
+import time
 import uuid
 import base64
 import hashlib
-from datetime import datetime
-from flask import Flask, request, jsonify, session
+import hmac
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+from flask import Flask, request, jsonify, session, g
 from flask_cors import CORS
+from flask_caching import Cache
+from flask_session import Session
+import redis
+import orjson
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from dotenv import load_dotenv
-from supabase import create_client, Client
 
 load_dotenv()
 
@@ -25,40 +41,135 @@ DATABASE_URL = os.getenv('DATABASE_URL')
 if not DATABASE_URL:
     raise Exception("DATABASE_URL not set!")
 
+REDIS_URL = os.getenv('REDIS_URL')
+rds: redis.Redis = None
+if REDIS_URL:
+    rds = redis.Redis.from_url(REDIS_URL)
+    cache = Cache(app, config={'CACHE_TYPE': 'RedisCache', 'CACHE_REDIS_URL': REDIS_URL, 'CACHE_DEFAULT_TIMEOUT': 30})
+    app.config.update(SESSION_TYPE='redis', SESSION_REDIS=rds)
+    Session(app)
+else:
+    print("WARNING: Redis not configured. Falling back to per-process cache and cookie sessions.")
+    cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 30})
+
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
-supabase: Client = None
+storage_http: httpx.Client = None
 if SUPABASE_URL and SUPABASE_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    storage_http = httpx.Client(
+        base_url=f"{SUPABASE_URL}/storage/v1",
+        headers={'Authorization': f'Bearer {SUPABASE_KEY}', 'apikey': SUPABASE_KEY},
+        timeout=httpx.Timeout(30, write=None),
+    )
+    # point STORAGE_CDN_URL at a CDN/custom domain fronting the public buckets
+    STORAGE_PUBLIC_URL = (os.getenv('STORAGE_CDN_URL') or f"{SUPABASE_URL}/storage/v1/object/public").rstrip('/')
 else:
     print("WARNING: Supabase not configured. File uploads will fail.")
 
+# each worker process has its own pool, so the total connection budget is split between them
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', 40))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', max(1, DB_MAX_CONNECTIONS // int(os.getenv('WEB_CONCURRENCY', 1)))))
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', min(2, DB_POOL_MAX)))
+
+pool = ConnectionPool(
+    DATABASE_URL,
+    min_size=DB_POOL_MIN,
+    max_size=DB_POOL_MAX,
+    # prepared statements break behind Supabase's transaction pooler (pgbouncer), which
+    # hands each transaction a different server connection
+    kwargs={'row_factory': dict_row, 'prepare_threshold': None},
+    # ping on checkout so connections killed by a restart/failover/idle timeout are replaced
+    check=ConnectionPool.check_connection,
+    timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+    max_idle=float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+    open=False,
+)
+pool.open()
+atexit.register(pool.close)
+
 def db():
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+    return pool.connection()
+
+ph = PasswordHasher()
 
+# argon2 is CPU-bound C code that gevent cannot switch away from; running it on the hub's
+# native threadpool keeps one login from stalling every other request on the worker
 def hash_pw(p):
-    return hashlib.sha256(p.encode()).hexdigest()
+    return get_hub().threadpool.apply(ph.hash, (p,))
+
+# verified against when there is no argon2 hash to check, so every login costs one argon2
+# verify and response time does not reveal whether a username exists
+DUMMY_HASH = ph.hash(uuid.uuid4().hex)
+
+def argon2_verify(stored, p):
+    try:
+        return get_hub().threadpool.apply(ph.verify, (stored, p))
+    except (VerificationError, InvalidHashError):
+        return False
+
+def check_pw(stored, p):
+    if stored is None:
+        argon2_verify(DUMMY_HASH, p)
+        return False
+    # accounts created before argon2 still hold an unsalted sha256 hex digest
+    if not stored.startswith('$argon2'):
+        argon2_verify(DUMMY_HASH, p)
+        return hmac.compare_digest(stored, hashlib.sha256(p.encode()).hexdigest())
+    return argon2_verify(stored, p)
+
+def pw_needs_rehash(stored):
+    return not stored.startswith('$argon2') or ph.check_needs_rehash(stored)
+
+@cache.memoize(timeout=60)
+def load_user(uid):
+    with db() as conn:
+        user = conn.execute("SELECT * FROM users WHERE id=%s", (uid,)).fetchone()
+    if not user:
+        return None
+    u = dict(user)
+    del u['password']
+    return u
 
 def current_user():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return None
-    with db() as conn:
-        return conn.execute("SELECT * FROM users WHERE id=%s", (uid,)).fetchone()
+    return load_user(uid)
+
+def unread_count(uid):
+    key = f'unread:{uid}'
+    n = cache.get(key)
+    if n is None:
+        with db() as conn:
+            n = conn.execute(
+                "SELECT COUNT(*) as c FROM notifications WHERE user_id=%s AND read=FALSE", (uid,)
+            ).fetchone()['c']
+        cache.set(key, n, timeout=60)
+    return n
+
+UPLOAD_CHUNK = 1 << 20
+
+def iter_upload(file_data):
+    if hasattr(file_data, 'read'):
+        while True:
+            chunk = file_data.read(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+    elif isinstance(file_data, str):
+        if ',' in file_data:
+            file_data = file_data.split(',')[1]
+        # decode on 4-char boundaries so each slice is valid base64 on its own
+        step = UPLOAD_CHUNK // 3 * 4
+        for i in range(0, len(file_data), step):
+            yield base64.b64decode(file_data[i:i + step])
+    else:
+        yield file_data
 
 def upload_file(file_data, filename, bucket='videos'):
-    if not supabase:
+    if not storage_http:
         return None
     try:
-        if hasattr(file_data, 'read'):
-            data = file_data.read()
-        elif isinstance(file_data, str):
-            if ',' in file_data:
-                file_data = file_data.split(',')[1]
-            data = base64.b64decode(file_data)
-        else:
-            data = file_data
-
         ext = filename.rsplit('.', 1)[-1] if '.' in filename else 'mp4'
         unique_name = f"{uuid.uuid4()}.{ext}"
 
@@ -67,11 +178,15 @@ def upload_file(file_data, filename, bucket='videos'):
             'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif', 'webp': 'image/webp'
         }
         ct = content_types.get(ext.lower(), 'application/octet-stream')
-
-        supabase.storage.from_(bucket).upload(
-            path=unique_name, file=data, file_options={"content-type": ct}
-        )
-        return supabase.storage.from_(bucket).get_public_url(unique_name)
+        headers = {'content-type': ct}
+        if hasattr(file_data, 'seek'):
+            file_data.seek(0, os.SEEK_END)
+            headers['content-length'] = str(file_data.tell())
+            file_data.seek(0)
+
+        resp = storage_http.post(f"/object/{bucket}/{unique_name}", content=iter_upload(file_data), headers=headers)
+        resp.raise_for_status()
+        return f"{STORAGE_PUBLIC_URL}/{bucket}/{unique_name}"
     except Exception as e:
         print(f"Upload error: {e}")
         return None
@@ -85,6 +200,35 @@ def fmt_video(v, uid=None):
     d['created_at'] = d.get('created')
     return d
 
+def orjson_default(o):
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError
+
+def ojson(obj, status=200):
+    return app.response_class(
+        orjson.dumps(obj, default=orjson_default, option=orjson.OPT_NAIVE_UTC),
+        status=status, mimetype='application/json'
+    )
+
+def list_cache_key():
+    # bumping list_version orphans every cached list response at once
+    return f"list:{cache.get('list_version') or 0}:{request.full_path}"
+
+def invalidate_lists():
+    cache.inc('list_version')
+
+cached_list = cache.cached(timeout=30, key_prefix=list_cache_key, unless=lambda: g.user_id)
+
+@app.before_request
+def load_session_user():
+    # without a session cookie there is nothing to load; leaving the session
+    # untouched also keeps anonymous responses free of Vary: Cookie
+    if not request.cookies.get(app.config['SESSION_COOKIE_NAME']):
+        g.user_id = None
+        return
+    g.user_id = session.get('user_id')
+
 # ─── AUTH ───
 
 @app.route('/api/register', methods=['POST'])
@@ -124,8 +268,11 @@ def login():
         user = conn.execute(
             "SELECT * FROM users WHERE LOWER(username)=LOWER(%s)", (username,)
         ).fetchone()
-        if not user or user['password'] != hash_pw(password):
+        if not check_pw(user['password'] if user else None, password):
             return jsonify({'error': 'نام کاربری یا رمز اشتباه است'}), 401
+        if pw_needs_rehash(user['password']):
+            conn.execute("UPDATE users SET password=%s WHERE id=%s", (hash_pw(password), user['id']))
+            conn.commit()
         session['user_id'] = user['id']
         u = dict(user)
         del u['password']
@@ -138,26 +285,22 @@ def logout():
 
 @app.route('/api/me', methods=['GET'])
 def me():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'user': None})
-    with db() as conn:
-        user = conn.execute("SELECT * FROM users WHERE id=%s", (uid,)).fetchone()
-        if not user:
-            return jsonify({'user': None})
-        u = dict(user)
-        del u['password']
-        unread = conn.execute(
-            "SELECT COUNT(*) as c FROM notifications WHERE user_id=%s AND read=FALSE", (uid,)
-        ).fetchone()['c']
-        u['unread'] = unread
-        return jsonify({'user': u, 'unread': unread})
+    user = load_user(uid)
+    if not user:
+        return jsonify({'user': None})
+    u = dict(user)
+    unread = unread_count(uid)
+    u['unread'] = unread
+    return jsonify({'user': u, 'unread': unread})
 
 # ─── UPLOAD ───
 
 @app.route('/api/upload', methods=['POST'])
 def upload_video():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
 
@@ -176,14 +319,14 @@ def upload_video():
     if not video_file:
         return jsonify({'error': 'فایل ویدیو یافت نشد'}), 400
 
-    video_url = upload_file(video_file, video_file.filename, 'videos')
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_video = ex.submit(upload_file, video_file, video_file.filename, 'videos')
+        f_thumb = ex.submit(upload_file, thumb_file, thumb_file.filename, 'thumbnails') if thumb_file else None
+        video_url = f_video.result()
+        thumb_url = f_thumb.result() if f_thumb else None
     if not video_url:
         return jsonify({'error': 'آپلود ویدیو ناموفق بود'}), 500
 
-    thumb_url = None
-    if thumb_file:
-        thumb_url = upload_file(thumb_file, thumb_file.filename, 'thumbnails')
-
     with db() as conn:
         video = conn.execute(
             """INSERT INTO videos (user_id, title, description, tags, video_url, thumbnail_url, duration, quality)
@@ -191,119 +334,227 @@ def upload_video():
             (uid, title[:200], description[:5000], tags[:500], video_url, thumb_url, float(duration), quality)
         ).fetchone()
         conn.commit()
+        invalidate_lists()
         return jsonify({'success': True, 'video_id': video['id']})
 
 # ─── VIDEOS ───
 
-def video_list_query(conn, sql, params, uid=None):
+VIDEO_CARD_COLS = ("v.id, v.user_id, v.title, v.thumbnail_url, v.video_url, v.duration, v.views, "
+                   "v.likes_count, v.dislikes_count, v.comments_count, v.created_at, v.is_short")
+
+def video_list_query(conn, sql, params):
     rows = conn.execute(sql, params).fetchall()
     result = []
     for r in rows:
         v = dict(r)
         if isinstance(v.get('created_at'), datetime):
             v['created'] = int(v['created_at'].timestamp())
-        if uid:
-            like = conn.execute(
-                "SELECT value FROM likes WHERE user_id=%s AND video_id=%s", (uid, v['id'])
-            ).fetchone()
-            v['user_liked'] = like['value'] if like else 0
         result.append(v)
     return result
 
 @app.route('/api/videos', methods=['GET'])
+@cached_list
 def get_videos():
     sort = request.args.get('sort', 'newest')
-    uid = session.get('user_id')
+    uid = g.user_id
     order = 'v.created_at DESC' if sort == 'newest' else 'v.views DESC'
     with db() as conn:
         videos = video_list_query(conn, f"""
-            SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
+            SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                   COALESCE(l.value, 0) as user_liked
             FROM videos v JOIN users u ON v.user_id=u.id
+            LEFT JOIN likes l ON l.video_id=v.id AND l.user_id=%s
             WHERE v.is_short=FALSE ORDER BY {order} LIMIT 30
-        """, (), uid)
-        return jsonify({'videos': videos})
+        """, (uid,))
+        return ojson({'videos': videos})
 
 @app.route('/api/videos/<int:vid>', methods=['GET'])
 def get_video(vid):
-    uid = session.get('user_id')
+    uid = g.user_id
     with db() as conn:
         r = conn.execute("""
             SELECT v.*, u.display_name as author_name, u.avatar as author_avatar,
                    u.verified as author_verified,
-                   (SELECT COUNT(*) FROM subscriptions WHERE channel_id=v.user_id) as channel_subs
+                   (SELECT COUNT(*) FROM subscriptions WHERE channel_id=v.user_id) as channel_subs,
+                   COALESCE((SELECT value FROM likes WHERE user_id=%s AND video_id=v.id), 0) as user_liked,
+                   EXISTS(SELECT 1 FROM subscriptions WHERE user_id=%s AND channel_id=v.user_id) as user_subscribed
             FROM videos v JOIN users u ON v.user_id=u.id WHERE v.id=%s
-        """, (vid,)).fetchone()
+        """, (uid, uid, vid)).fetchone()
         if not r:
             return jsonify({'error': 'ویدیو یافت نشد'}), 404
         v = dict(r)
+        v.pop('search_tsv', None)
         if isinstance(v.get('created_at'), datetime):
             v['created'] = int(v['created_at'].timestamp())
-        if uid:
-            like = conn.execute("SELECT value FROM likes WHERE user_id=%s AND video_id=%s", (uid, vid)).fetchone()
-            v['user_liked'] = like['value'] if like else 0
-            sub = conn.execute("SELECT id FROM subscriptions WHERE user_id=%s AND channel_id=%s", (uid, v['user_id'])).fetchone()
-            v['user_subscribed'] = bool(sub)
-        else:
-            v['user_liked'] = 0
-            v['user_subscribed'] = False
         return jsonify(v)
 
 @app.route('/api/shorts', methods=['GET'])
+@cached_list
 def get_shorts():
-    uid = session.get('user_id')
+    uid = g.user_id
     with db() as conn:
-        videos = video_list_query(conn, """
-            SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
+        videos = video_list_query(conn, f"""
+            SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                   COALESCE(l.value, 0) as user_liked
             FROM videos v JOIN users u ON v.user_id=u.id
+            LEFT JOIN likes l ON l.video_id=v.id AND l.user_id=%s
             WHERE v.is_short=TRUE ORDER BY v.created_at DESC LIMIT 20
-        """, (), uid)
-        return jsonify({'videos': videos})
+        """, (uid,))
+        return ojson({'videos': videos})
+
+TRENDING_REFRESH_INTERVAL = int(os.getenv('TRENDING_REFRESH_INTERVAL', 60))
+
+def trending_refresher():
+    while True:
+        time.sleep(TRENDING_REFRESH_INTERVAL)
+        try:
+            with db() as conn:
+                # claim the refresh by moving the timestamp forward; workers that find it
+                # already fresh update nothing and skip. A failed refresh rolls the claim back.
+                claimed = conn.execute("""
+                    UPDATE videos_trending_refresh SET refreshed_at=now()
+                    WHERE refreshed_at <= now() - make_interval(secs => %s) RETURNING 1
+                """, (TRENDING_REFRESH_INTERVAL,)).fetchone()
+                if claimed:
+                    conn.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY videos_trending")
+                conn.commit()
+        except Exception as e:
+            print(f"Trending refresh error: {e}")
+
+threading.Thread(target=trending_refresher, daemon=True).start()
 
 @app.route('/api/trending', methods=['GET'])
+@cached_list
 def trending():
-    uid = session.get('user_id')
+    uid = g.user_id
     with db() as conn:
-        videos = video_list_query(conn, """
-            SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
-            FROM videos v JOIN users u ON v.user_id=u.id
-            ORDER BY (v.views * 2 + v.likes_count) DESC LIMIT 30
-        """, (), uid)
-        return jsonify({'videos': videos})
+        videos = video_list_query(conn, f"""
+            SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                   COALESCE(l.value, 0) as user_liked
+            FROM videos_trending t JOIN videos v ON v.id=t.id JOIN users u ON v.user_id=u.id
+            LEFT JOIN likes l ON l.video_id=v.id AND l.user_id=%s
+            ORDER BY t.score DESC LIMIT 30
+        """, (uid,))
+        return ojson({'videos': videos})
 
 @app.route('/api/search', methods=['GET'])
 def search():
     q = request.args.get('q', '').strip()
-    uid = session.get('user_id')
+    uid = g.user_id
     if not q:
         return jsonify({'videos': []})
     with db() as conn:
-        videos = video_list_query(conn, """
-            SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
+        videos = video_list_query(conn, f"""
+            SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                   COALESCE(l.value, 0) as user_liked
             FROM videos v JOIN users u ON v.user_id=u.id
-            WHERE v.title ILIKE %s OR v.description ILIKE %s OR v.tags ILIKE %s
-            ORDER BY v.views DESC LIMIT 30
-        """, (f'%{q}%', f'%{q}%', f'%{q}%'), uid)
-        return jsonify({'videos': videos})
+            LEFT JOIN likes l ON l.video_id=v.id AND l.user_id=%s
+            WHERE v.search_tsv @@ plainto_tsquery('simple', %s)
+            ORDER BY ts_rank(v.search_tsv, plainto_tsquery('simple', %s)) DESC, v.views DESC LIMIT 30
+        """, (uid, q, q))
+        return ojson({'videos': videos})
+
+VIEW_FLUSH_INTERVAL = int(os.getenv('VIEW_FLUSH_INTERVAL', 10))
+
+# read-and-reset in one script so a concurrent INCR is never lost between GET and DEL
+POP_COUNTERS = """
+local out = {}
+for i, k in ipairs(KEYS) do
+    out[i] = redis.call('GET', k) or '0'
+    redis.call('DEL', k)
+end
+return out
+"""
+POP_ZSET = """
+local r = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+redis.call('DEL', KEYS[1])
+return r
+"""
+
+def flush_views():
+    keys = list(rds.scan_iter('views:*', count=1000))
+    if keys:
+        counts = rds.eval(POP_COUNTERS, len(keys), *keys)
+        pending = {int(k.split(b':', 1)[1]): int(n) for k, n in zip(keys, counts) if int(n)}
+        if pending:
+            try:
+                with db() as conn:
+                    conn.execute("""
+                        UPDATE videos SET views=views+d.n
+                        FROM UNNEST(%s::bigint[], %s::bigint[]) AS d(id, n) WHERE videos.id=d.id
+                    """, (list(pending), list(pending.values())))
+                    conn.commit()
+            except psycopg.OperationalError:
+                # connection trouble: put the popped counts back so the next flush retries them
+                for vid, n in pending.items():
+                    rds.incrby(f'views:{vid}', n)
+                raise
+
+    rows = []
+    for k in rds.scan_iter('history:*', count=1000):
+        uid = int(k.split(b':', 1)[1])
+        flat = rds.eval(POP_ZSET, 1, k)
+        for vid, ts in zip(flat[::2], flat[1::2]):
+            rows.append((uid, int(vid), datetime.fromtimestamp(float(ts), timezone.utc)))
+    if rows:
+        users, vids, stamps = zip(*rows)
+        try:
+            with db() as conn:
+                # rows for videos or users deleted since the view are dropped, not retried
+                conn.execute("""
+                    INSERT INTO history (user_id, video_id, watched_at)
+                    SELECT d.user_id, d.video_id, d.watched_at
+                    FROM UNNEST(%s::bigint[], %s::bigint[], %s::timestamptz[]) AS d(user_id, video_id, watched_at)
+                    WHERE EXISTS (SELECT 1 FROM videos WHERE id=d.video_id)
+                      AND EXISTS (SELECT 1 FROM users WHERE id=d.user_id)
+                    ON CONFLICT (user_id,video_id) DO UPDATE SET watched_at=GREATEST(history.watched_at, EXCLUDED.watched_at)
+                """, (list(users), list(vids), list(stamps)))
+                conn.commit()
+        except psycopg.OperationalError:
+            # only transient failures are re-queued; a data error would otherwise wedge every later flush
+            for uid, vid, ts in rows:
+                rds.zadd(f'history:{uid}', {vid: ts.timestamp()}, gt=True)
+            raise
+
+def view_flusher():
+    while True:
+        time.sleep(VIEW_FLUSH_INTERVAL)
+        try:
+            flush_views()
+        except Exception as e:
+            print(f"View flush error: {e}")
+
+if rds:
+    threading.Thread(target=view_flusher, daemon=True).start()
 
 @app.route('/api/view', methods=['POST'])
 def add_view():
     data = request.json
     vid = data.get('video_id')
     if vid:
+        uid = g.user_id
+        if rds:
+            vid = int(vid)
+            with rds.pipeline(transaction=False) as p:
+                p.incr(f'views:{vid}')
+                if uid:
+                    p.zadd(f'history:{uid}', {vid: time.time()})
+                p.execute()
+            return jsonify({'success': True})
         with db() as conn:
-            conn.execute("UPDATE videos SET views=views+1 WHERE id=%s", (vid,))
-            uid = session.get('user_id')
-            if uid:
-                conn.execute(
-                    "INSERT INTO history (user_id, video_id) VALUES (%s,%s) ON CONFLICT (user_id,video_id) DO UPDATE SET watched_at=NOW()",
-                    (uid, vid)
-                )
+            with conn.pipeline():
+                conn.execute("UPDATE videos SET views=views+1 WHERE id=%s", (vid,))
+                if uid:
+                    conn.execute(
+                        "INSERT INTO history (user_id, video_id) VALUES (%s,%s) ON CONFLICT (user_id,video_id) DO UPDATE SET watched_at=NOW()",
+                        (uid, vid)
+                    )
             conn.commit()
     return jsonify({'success': True})
 
 @app.route('/api/like', methods=['POST'])
 def like_video():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     data = request.json
@@ -311,42 +562,42 @@ def like_video():
     value = data.get('value', 1)  # 1=like, -1=dislike, 0=remove
 
     with db() as conn:
-        existing = conn.execute("SELECT value FROM likes WHERE user_id=%s AND video_id=%s", (uid, vid)).fetchone()
-        if existing:
-            if value == 0 or existing['value'] == value:
-                conn.execute("DELETE FROM likes WHERE user_id=%s AND video_id=%s", (uid, vid))
-                # update counts
-                if existing['value'] == 1:
-                    conn.execute("UPDATE videos SET likes_count=GREATEST(0,likes_count-1) WHERE id=%s", (vid,))
-                else:
-                    conn.execute("UPDATE videos SET dislikes_count=GREATEST(0,dislikes_count-1) WHERE id=%s", (vid,))
-                user_liked = 0
-            else:
-                conn.execute("UPDATE likes SET value=%s WHERE user_id=%s AND video_id=%s", (value, uid, vid))
-                if value == 1:
-                    conn.execute("UPDATE videos SET likes_count=likes_count+1, dislikes_count=GREATEST(0,dislikes_count-1) WHERE id=%s", (vid,))
-                else:
-                    conn.execute("UPDATE videos SET dislikes_count=dislikes_count+1, likes_count=GREATEST(0,likes_count-1) WHERE id=%s", (vid,))
-                user_liked = value
-        else:
-            if value != 0:
-                conn.execute("INSERT INTO likes (user_id, video_id, value) VALUES (%s,%s,%s)", (uid, vid, value))
-                if value == 1:
-                    conn.execute("UPDATE videos SET likes_count=likes_count+1 WHERE id=%s", (vid,))
-                else:
-                    conn.execute("UPDATE videos SET dislikes_count=dislikes_count+1 WHERE id=%s", (vid,))
-                user_liked = value
-            else:
-                user_liked = 0
+        # toggling the same value (or sending 0) removes the like; counts move by (new - prev)
+        v = conn.execute("""
+            WITH prev AS (
+                SELECT value FROM likes WHERE user_id=%(uid)s AND video_id=%(vid)s
+            ), new AS (
+                SELECT CASE WHEN %(value)s = 0 OR %(value)s = (SELECT value FROM prev) THEN 0
+                            ELSE %(value)s END AS value
+            ), del AS (
+                DELETE FROM likes WHERE user_id=%(uid)s AND video_id=%(vid)s AND (SELECT value FROM new) = 0
+            ), ins AS (
+                INSERT INTO likes (user_id, video_id, value)
+                SELECT %(uid)s, vv.id, n.value FROM new n JOIN videos vv ON vv.id=%(vid)s WHERE n.value <> 0
+                ON CONFLICT (user_id, video_id) DO UPDATE SET value=EXCLUDED.value
+            ), upd AS (
+                UPDATE videos SET
+                    likes_count=GREATEST(0, likes_count
+                        + CASE WHEN n.value=1 THEN 1 ELSE 0 END - CASE WHEN p.value=1 THEN 1 ELSE 0 END),
+                    dislikes_count=GREATEST(0, dislikes_count
+                        + CASE WHEN n.value=-1 THEN 1 ELSE 0 END - CASE WHEN p.value=-1 THEN 1 ELSE 0 END)
+                FROM new n LEFT JOIN prev p ON TRUE
+                WHERE videos.id=%(vid)s
+                RETURNING likes_count, dislikes_count, n.value AS user_liked
+            )
+            SELECT * FROM upd
+        """, {'uid': uid, 'vid': vid, 'value': value}).fetchone()
+        if not v:
+            return jsonify({'error': 'ویدیو یافت نشد'}), 404
         conn.commit()
-        v = conn.execute("SELECT likes_count, dislikes_count FROM videos WHERE id=%s", (vid,)).fetchone()
-        return jsonify({'success': True, 'user_liked': user_liked, 'likes': v['likes_count'], 'dislikes': v['dislikes_count']})
+        invalidate_lists()
+        return jsonify({'success': True, 'user_liked': v['user_liked'], 'likes': v['likes_count'], 'dislikes': v['dislikes_count']})
 
 # ─── COMMENTS ───
 
 @app.route('/api/comments/<int:vid>', methods=['GET'])
 def get_comments(vid):
-    uid = session.get('user_id')
+    uid = g.user_id
     with db() as conn:
         rows = conn.execute("""
             SELECT c.*, u.display_name as author_name, u.avatar as author_avatar
@@ -354,31 +605,42 @@ def get_comments(vid):
             WHERE c.video_id=%s AND c.parent_id IS NULL
             ORDER BY c.pinned DESC, c.likes_count DESC, c.created_at DESC LIMIT 100
         """, (vid,)).fetchall()
+        ids = [r['id'] for r in rows]
+        replies = {}
+        liked = set()
+        if ids:
+            # first 20 replies per parent, capped in SQL so busy threads don't flood the page
+            for rr in conn.execute("""
+                SELECT * FROM (
+                    SELECT c2.*, u2.display_name as author_name, u2.avatar as author_avatar,
+                           ROW_NUMBER() OVER (PARTITION BY c2.parent_id ORDER BY c2.created_at ASC) as rn
+                    FROM comments c2 JOIN users u2 ON c2.user_id=u2.id
+                    WHERE c2.video_id=%s AND c2.parent_id = ANY(%s)
+                ) s WHERE rn <= 20 ORDER BY created_at ASC
+            """, (vid, ids)).fetchall():
+                rep = dict(rr)
+                del rep['rn']
+                if isinstance(rep.get('created_at'), datetime):
+                    rep['created'] = int(rep['created_at'].timestamp())
+                replies.setdefault(rep['parent_id'], []).append(rep)
+            if uid:
+                liked = {cl['comment_id'] for cl in conn.execute(
+                    "SELECT comment_id FROM comment_likes WHERE user_id=%s AND comment_id = ANY(%s)", (uid, ids)
+                ).fetchall()}
         comments = []
         for r in rows:
             c = dict(r)
             if isinstance(c.get('created_at'), datetime):
                 c['created'] = int(c['created_at'].timestamp())
             if uid:
-                cl = conn.execute("SELECT id FROM comment_likes WHERE user_id=%s AND comment_id=%s", (uid, c['id'])).fetchone()
-                c['user_liked'] = bool(cl)
-            replies = conn.execute("""
-                SELECT c2.*, u2.display_name as author_name, u2.avatar as author_avatar
-                FROM comments c2 JOIN users u2 ON c2.user_id=u2.id
-                WHERE c2.parent_id=%s ORDER BY c2.created_at ASC LIMIT 20
-            """, (c['id'],)).fetchall()
-            c['replies'] = []
-            for rr in replies:
-                rep = dict(rr)
-                if isinstance(rep.get('created_at'), datetime):
-                    rep['created'] = int(rep['created_at'].timestamp())
-                c['replies'].append(rep)
+                c['user_liked'] = c['id'] in liked
+            c['replies'] = replies.get(c['id'], [])
             comments.append(c)
-        return jsonify({'comments': comments})
+        return ojson({'comments': comments})
 
 @app.route('/api/comment', methods=['POST'])
 def add_comment():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     data = request.json
@@ -387,24 +649,29 @@ def add_comment():
     if not text:
         return jsonify({'error': 'متن خالی'}), 400
     with db() as conn:
-        c = conn.execute(
-            "INSERT INTO comments (user_id, video_id, text) VALUES (%s,%s,%s) RETURNING *",
-            (uid, vid, text[:1000])
-        ).fetchone()
-        conn.execute("UPDATE videos SET comments_count=comments_count+1 WHERE id=%s", (vid,))
-        # notify video owner
-        video = conn.execute("SELECT user_id FROM videos WHERE id=%s", (vid,)).fetchone()
-        if video and video['user_id'] != uid:
-            conn.execute(
-                "INSERT INTO notifications (user_id, from_user_id, type, video_id) VALUES (%s,%s,'comment',%s)",
-                (video['user_id'], uid, vid)
+        # insert, bump the counter and notify the video owner in one round-trip
+        c = conn.execute("""
+            WITH c AS (
+                INSERT INTO comments (user_id, video_id, text) VALUES (%(uid)s, %(vid)s, %(text)s) RETURNING *
+            ), v AS (
+                UPDATE videos SET comments_count=comments_count+1 WHERE id=(SELECT video_id FROM c) RETURNING user_id
+            ), n AS (
+                INSERT INTO notifications (user_id, from_user_id, type, video_id)
+                SELECT v.user_id, %(uid)s, 'comment', c.video_id FROM v, c WHERE v.user_id <> %(uid)s
+                RETURNING user_id
             )
+            SELECT c.*, (SELECT user_id FROM n) as notified_user FROM c
+        """, {'uid': uid, 'vid': vid, 'text': text[:1000]}).fetchone()
         conn.commit()
-        return jsonify({'success': True, 'comment': dict(c)})
+        c = dict(c)
+        notified = c.pop('notified_user')
+        if notified:
+            cache.delete(f'unread:{notified}')
+        return jsonify({'success': True, 'comment': c})
 
 @app.route('/api/comment_reply', methods=['POST'])
 def reply_comment():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     data = request.json
@@ -423,26 +690,27 @@ def reply_comment():
 
 @app.route('/api/comment_like', methods=['POST'])
 def like_comment():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     cid = request.json.get('comment_id')
     with db() as conn:
         existing = conn.execute("SELECT id FROM comment_likes WHERE user_id=%s AND comment_id=%s", (uid, cid)).fetchone()
-        if existing:
-            conn.execute("DELETE FROM comment_likes WHERE user_id=%s AND comment_id=%s", (uid, cid))
-            conn.execute("UPDATE comments SET likes_count=GREATEST(0,likes_count-1) WHERE id=%s", (cid,))
-            liked = False
-        else:
-            conn.execute("INSERT INTO comment_likes (user_id, comment_id) VALUES (%s,%s)", (uid, cid))
-            conn.execute("UPDATE comments SET likes_count=likes_count+1 WHERE id=%s", (cid,))
-            liked = True
+        with conn.pipeline():
+            if existing:
+                conn.execute("DELETE FROM comment_likes WHERE user_id=%s AND comment_id=%s", (uid, cid))
+                conn.execute("UPDATE comments SET likes_count=GREATEST(0,likes_count-1) WHERE id=%s", (cid,))
+                liked = False
+            else:
+                conn.execute("INSERT INTO comment_likes (user_id, comment_id) VALUES (%s,%s)", (uid, cid))
+                conn.execute("UPDATE comments SET likes_count=likes_count+1 WHERE id=%s", (cid,))
+                liked = True
         conn.commit()
         return jsonify({'success': True, 'liked': liked})
 
 @app.route('/api/delete_comment', methods=['POST'])
 def delete_comment():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     cid = request.json.get('comment_id')
@@ -453,7 +721,7 @@ def delete_comment():
 
 @app.route('/api/pin_comment', methods=['POST'])
 def pin_comment():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     cid = request.json.get('comment_id')
@@ -472,64 +740,75 @@ def pin_comment():
 
 @app.route('/api/subscribe', methods=['POST'])
 def subscribe():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     channel_id = request.json.get('channel_id')
     with db() as conn:
-        existing = conn.execute("SELECT id FROM subscriptions WHERE user_id=%s AND channel_id=%s", (uid, channel_id)).fetchone()
-        if existing:
-            conn.execute("DELETE FROM subscriptions WHERE user_id=%s AND channel_id=%s", (uid, channel_id))
-            subscribed = False
-        else:
-            conn.execute("INSERT INTO subscriptions (user_id, channel_id) VALUES (%s,%s)", (uid, channel_id))
-            conn.execute(
-                "INSERT INTO notifications (user_id, from_user_id, type) VALUES (%s,%s,'subscribe')",
-                (channel_id, uid)
+        # toggle: delete if present, otherwise subscribe and notify the channel, in one statement
+        subscribed = conn.execute("""
+            WITH del AS (
+                DELETE FROM subscriptions WHERE user_id=%(uid)s AND channel_id=%(ch)s RETURNING id
+            ), s AS (
+                INSERT INTO subscriptions (user_id, channel_id)
+                SELECT %(uid)s, u.id FROM users u WHERE u.id=%(ch)s AND NOT EXISTS (SELECT 1 FROM del)
+                ON CONFLICT DO NOTHING RETURNING channel_id
+            ), n AS (
+                INSERT INTO notifications (user_id, from_user_id, type)
+                SELECT channel_id, %(uid)s, 'subscribe' FROM s RETURNING 1
             )
-            subscribed = True
+            SELECT EXISTS (SELECT 1 FROM s) as subscribed
+        """, {'uid': uid, 'ch': channel_id}).fetchone()['subscribed']
         conn.commit()
+        if subscribed:
+            cache.delete(f'unread:{channel_id}')
         return jsonify({'success': True, 'subscribed': subscribed})
 
 @app.route('/api/subscriptions', methods=['GET'])
 def subscriptions():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'videos': []})
     with db() as conn:
-        videos = video_list_query(conn, """
-            SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
+        videos = video_list_query(conn, f"""
+            SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                   COALESCE(l.value, 0) as user_liked
             FROM videos v JOIN users u ON v.user_id=u.id
+            LEFT JOIN likes l ON l.video_id=v.id AND l.user_id=%s
             WHERE v.user_id IN (SELECT channel_id FROM subscriptions WHERE user_id=%s)
             ORDER BY v.created_at DESC LIMIT 30
-        """, (uid,), uid)
-        return jsonify({'videos': videos})
+        """, (uid, uid))
+        return ojson({'videos': videos})
 
 @app.route('/api/feed', methods=['GET'])
+@cached_list
 def feed():
-    uid = session.get('user_id')
+    uid = g.user_id
     with db() as conn:
         if uid:
-            videos = video_list_query(conn, """
-                SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
+            videos = video_list_query(conn, f"""
+                SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                       COALESCE(l.value, 0) as user_liked
                 FROM videos v JOIN users u ON v.user_id=u.id
+                LEFT JOIN likes l ON l.video_id=v.id AND l.user_id=%s
                 WHERE v.user_id IN (SELECT channel_id FROM subscriptions WHERE user_id=%s)
                    OR v.views > 100
                 ORDER BY v.created_at DESC LIMIT 20
-            """, (uid,), uid)
+            """, (uid, uid))
         else:
-            videos = video_list_query(conn, """
-                SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
+            videos = video_list_query(conn, f"""
+                SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                       0 as user_liked
                 FROM videos v JOIN users u ON v.user_id=u.id
                 ORDER BY v.views DESC LIMIT 20
-            """, (), None)
-        return jsonify({'videos': videos})
+            """, ())
+        return ojson({'videos': videos})
 
 # ─── USER / CHANNEL ───
 
 @app.route('/api/user/<int:uid_param>', methods=['GET'])
 def get_user(uid_param):
-    uid = session.get('user_id')
+    uid = g.user_id
     with db() as conn:
         user = conn.execute("SELECT id,username,display_name,avatar,bio,verified,created_at FROM users WHERE id=%s", (uid_param,)).fetchone()
         if not user:
@@ -543,18 +822,20 @@ def get_user(uid_param):
 
 @app.route('/api/user/<int:uid_param>/videos', methods=['GET'])
 def user_videos(uid_param):
-    uid = session.get('user_id')
+    uid = g.user_id
     with db() as conn:
-        videos = video_list_query(conn, """
-            SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
+        videos = video_list_query(conn, f"""
+            SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                   COALESCE(l.value, 0) as user_liked
             FROM videos v JOIN users u ON v.user_id=u.id
+            LEFT JOIN likes l ON l.video_id=v.id AND l.user_id=%s
             WHERE v.user_id=%s ORDER BY v.created_at DESC LIMIT 50
-        """, (uid_param,), uid)
-        return jsonify({'videos': videos})
+        """, (uid, uid_param))
+        return ojson({'videos': videos})
 
 @app.route('/api/update_profile', methods=['POST'])
 def update_profile():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
 
@@ -562,28 +843,28 @@ def update_profile():
     bio = request.form.get('bio') or ''
     avatar_file = request.files.get('avatar')
 
-    with db() as conn:
-        avatar_url = None
-        if avatar_file:
-            avatar_url = upload_file(avatar_file, avatar_file.filename, 'avatars')
+    avatar_url = None
+    if avatar_file:
+        avatar_url = upload_file(avatar_file, avatar_file.filename, 'avatars')
 
+    with db() as conn:
         if avatar_url:
-            conn.execute(
-                "UPDATE users SET display_name=%s, bio=%s, avatar=%s WHERE id=%s",
+            user = conn.execute(
+                "UPDATE users SET display_name=%s, bio=%s, avatar=%s WHERE id=%s RETURNING id,username,display_name,avatar,bio,verified",
                 (display_name[:100], bio[:300], avatar_url, uid)
-            )
+            ).fetchone()
         else:
-            conn.execute(
-                "UPDATE users SET display_name=%s, bio=%s WHERE id=%s",
+            user = conn.execute(
+                "UPDATE users SET display_name=%s, bio=%s WHERE id=%s RETURNING id,username,display_name,avatar,bio,verified",
                 (display_name[:100], bio[:300], uid)
-            )
+            ).fetchone()
         conn.commit()
-        user = conn.execute("SELECT id,username,display_name,avatar,bio,verified FROM users WHERE id=%s", (uid,)).fetchone()
+        cache.delete_memoized(load_user, uid)
         return jsonify({'success': True, 'user': dict(user)})
 
 @app.route('/api/change_password', methods=['POST'])
 def change_password():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     data = request.json
@@ -593,7 +874,7 @@ def change_password():
         return jsonify({'error': 'رمز جدید حداقل ۶ کاراکتر'}), 400
     with db() as conn:
         user = conn.execute("SELECT password FROM users WHERE id=%s", (uid,)).fetchone()
-        if user['password'] != hash_pw(old_pw):
+        if not check_pw(user['password'], old_pw):
             return jsonify({'error': 'رمز فعلی اشتباه است'}), 401
         conn.execute("UPDATE users SET password=%s WHERE id=%s", (hash_pw(new_pw), uid))
         conn.commit()
@@ -603,21 +884,23 @@ def change_password():
 
 @app.route('/api/history', methods=['GET'])
 def history():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'videos': []})
     with db() as conn:
-        videos = video_list_query(conn, """
-            SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
+        videos = video_list_query(conn, f"""
+            SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                   COALESCE(l.value, 0) as user_liked
             FROM videos v JOIN users u ON v.user_id=u.id
+            LEFT JOIN likes l ON l.video_id=v.id AND l.user_id=%s
             JOIN history h ON h.video_id=v.id
             WHERE h.user_id=%s ORDER BY h.watched_at DESC LIMIT 50
-        """, (uid,), uid)
-        return jsonify({'videos': videos})
+        """, (uid, uid))
+        return ojson({'videos': videos})
 
 @app.route('/api/watchlater', methods=['POST'])
 def watchlater():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     vid = request.json.get('video_id')
@@ -634,52 +917,59 @@ def watchlater():
 
 @app.route('/api/watchlater', methods=['GET'])
 def get_watchlater():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'videos': []})
     with db() as conn:
-        videos = video_list_query(conn, """
-            SELECT v.*, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified
+        videos = video_list_query(conn, f"""
+            SELECT {VIDEO_CARD_COLS}, u.display_name as author_name, u.avatar as author_avatar, u.verified as author_verified,
+                   COALESCE(l.value, 0) as user_liked
             FROM videos v JOIN users u ON v.user_id=u.id
+            LEFT JOIN likes l ON l.video_id=v.id AND l.user_id=%s
             JOIN watchlater wl ON wl.video_id=v.id
             WHERE wl.user_id=%s ORDER BY wl.created_at DESC LIMIT 50
-        """, (uid,), uid)
-        return jsonify({'videos': videos})
+        """, (uid, uid))
+        return ojson({'videos': videos})
 
 # ─── NOTIFICATIONS ───
 
 @app.route('/api/notifications', methods=['GET'])
 def notifications():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'notifications': []})
     with db() as conn:
+        # the SELECT sees the pre-update snapshot, so rows keep their old read flag
         rows = conn.execute("""
+            WITH updated AS (
+                UPDATE notifications SET read=TRUE WHERE user_id=%s AND read=FALSE RETURNING id
+            )
             SELECT n.*, u.display_name as from_name, u.avatar as from_avatar
             FROM notifications n JOIN users u ON n.from_user_id=u.id
             WHERE n.user_id=%s ORDER BY n.created_at DESC LIMIT 50
-        """, (uid,)).fetchall()
+        """, (uid, uid)).fetchall()
         ns = []
         for r in rows:
             n = dict(r)
             if isinstance(n.get('created_at'), datetime):
                 n['created'] = int(n['created_at'].timestamp())
             ns.append(n)
-        conn.execute("UPDATE notifications SET read=TRUE WHERE user_id=%s", (uid,))
         conn.commit()
-        return jsonify({'notifications': ns})
+        cache.set(f'unread:{uid}', 0, timeout=60)
+        return ojson({'notifications': ns})
 
 # ─── DELETE VIDEO ───
 
 @app.route('/api/delete_video', methods=['POST'])
 def delete_video():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     vid = request.json.get('video_id')
     with db() as conn:
         conn.execute("DELETE FROM videos WHERE id=%s AND user_id=%s", (vid, uid))
         conn.commit()
+        invalidate_lists()
         return jsonify({'success': True})
 
 # ─── MISC ───
@@ -695,7 +985,7 @@ def share():
 
 @app.route('/api/report', methods=['POST'])
 def report():
-    uid = session.get('user_id')
+    uid = g.user_id
     data = request.json
     with db() as conn:
         conn.execute(
@@ -711,15 +1001,17 @@ def algorithm():
 
 @app.route('/api/analytics', methods=['GET'])
 def analytics():
-    uid = session.get('user_id')
+    uid = g.user_id
     if not uid:
         return jsonify({'error': 'لطفاً وارد شوید'}), 401
     with db() as conn:
-        vc = conn.execute("SELECT COUNT(*) as c FROM videos WHERE user_id=%s", (uid,)).fetchone()['c']
-        tv = conn.execute("SELECT COALESCE(SUM(views),0) as s FROM videos WHERE user_id=%s", (uid,)).fetchone()['s']
-        subs = conn.execute("SELECT COUNT(*) as c FROM subscriptions WHERE channel_id=%s", (uid,)).fetchone()['c']
-        tl = conn.execute("SELECT COALESCE(SUM(likes_count),0) as s FROM videos WHERE user_id=%s", (uid,)).fetchone()['s']
-        return jsonify({'video_count': vc, 'total_views': tv, 'subscribers': subs, 'total_likes': tl})
+        stats = conn.execute("""
+            SELECT COUNT(*) as video_count, COALESCE(SUM(views),0) as total_views,
+                   COALESCE(SUM(likes_count),0) as total_likes,
+                   (SELECT COUNT(*) FROM subscriptions WHERE channel_id=%s) as subscribers
+            FROM videos WHERE user_id=%s
+        """, (uid, uid)).fetchone()
+        return jsonify(dict(stats))
 
 @app.route('/health')
 def health():
@@ -0,0 +1,13 @@
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 10000)}"
+# gevent workers multiplex I/O themselves, so a few are enough; cpu_count() also
+# reports host cores inside containers and would oversubscribe Postgres
+workers = int(os.getenv('WEB_CONCURRENCY', 4))
+# app.py splits DB_MAX_CONNECTIONS across this many per-worker pools
+os.environ['WEB_CONCURRENCY'] = str(workers)
+# a worker is one gevent hub: CPU-bound work (argon2 in app.py) must go through the hub
+# threadpool, or it stalls every connection on that worker while it runs
+worker_class = 'gevent'
+worker_connections = 1000
+keepalive = 30
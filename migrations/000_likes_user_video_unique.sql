@@ -0,0 +1,5 @@
+-- Conflict target of the upsert in /api/like; must exist before that handler is deployed.
+-- CONCURRENTLY cannot run inside a transaction: apply with plain `psql -f`, not `psql -1`.
+-- Fails if duplicate (user_id, video_id) rows already exist; dedupe likes first.
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS likes_user_video ON likes (user_id, video_id);
@@ -0,0 +1,15 @@
+-- Indexes backing the hot queries in app.py.
+-- CONCURRENTLY cannot run inside a transaction: apply with plain `psql -f`, not `psql -1`.
+-- The UNIQUE index fails if duplicate subscriptions already exist; dedupe them first.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS videos_user_created ON videos (user_id, created_at DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS videos_is_short_created ON videos (is_short, created_at DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_video_parent ON comments (video_id, parent_id, created_at DESC);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS subscriptions_user_channel ON subscriptions (user_id, channel_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS subscriptions_channel ON subscriptions (channel_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS history_user_watched ON history (user_id, watched_at DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notifications_unread ON notifications (user_id) WHERE read = FALSE;
@@ -0,0 +1,43 @@
+-- Full-text search column for /api/search, weighted title > tags > description.
+-- 'simple' config: no stemming, so Persian and mixed-language titles tokenise the same way.
+-- Safe on a live database: a plain nullable column is a metadata-only change, new writes are
+-- kept current by a trigger, and existing rows are backfilled in committed batches.
+-- The backfill COMMITs inside DO: apply with plain `psql -f`, not `psql -1`.
+
+ALTER TABLE videos ADD COLUMN IF NOT EXISTS search_tsv tsvector;
+
+CREATE OR REPLACE FUNCTION videos_search_tsv(title text, tags text, description text)
+RETURNS tsvector LANGUAGE sql IMMUTABLE AS $$
+    SELECT setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('simple', coalesce(tags, '')), 'B') ||
+           setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+$$;
+
+CREATE OR REPLACE FUNCTION videos_search_tsv_trigger() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.search_tsv := videos_search_tsv(NEW.title, NEW.tags, NEW.description);
+    RETURN NEW;
+END
+$$;
+
+DROP TRIGGER IF EXISTS videos_search_tsv ON videos;
+CREATE TRIGGER videos_search_tsv BEFORE INSERT OR UPDATE OF title, tags, description ON videos
+    FOR EACH ROW EXECUTE FUNCTION videos_search_tsv_trigger();
+
+-- rows written from here on are covered by the trigger; fill in the rest 5000 ids at a time
+DO $$
+DECLARE
+    last_id bigint := 0;
+    max_id bigint;
+BEGIN
+    SELECT coalesce(max(id), 0) INTO max_id FROM videos;
+    WHILE last_id < max_id LOOP
+        UPDATE videos SET search_tsv = videos_search_tsv(title, tags, description)
+        WHERE id > last_id AND id <= last_id + 5000 AND search_tsv IS NULL;
+        last_id := last_id + 5000;
+        COMMIT;
+    END LOOP;
+END
+$$;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS videos_tsv ON videos USING GIN (search_tsv);
@@ -0,0 +1,9 @@
+-- Precomputed trending rank for /api/trending, refreshed by the app every TRENDING_REFRESH_INTERVAL seconds.
+-- The unique index is required for REFRESH MATERIALIZED VIEW CONCURRENTLY.
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS videos_trending AS
+    SELECT id, (views * 2 + likes_count) AS score
+    FROM videos ORDER BY score DESC LIMIT 1000;
+
+CREATE UNIQUE INDEX IF NOT EXISTS videos_trending_id ON videos_trending (id);
+CREATE INDEX IF NOT EXISTS videos_trending_score ON videos_trending (score DESC);
@@ -0,0 +1,6 @@
+-- Single-row timestamp of the last videos_trending refresh. Every gunicorn worker runs the
+-- refresher, and the one that moves this timestamp forward is the only one that refreshes.
+
+CREATE TABLE IF NOT EXISTS videos_trending_refresh (refreshed_at timestamptz NOT NULL);
+INSERT INTO videos_trending_refresh (refreshed_at)
+    SELECT '-infinity' WHERE NOT EXISTS (SELECT 1 FROM videos_trending_refresh);